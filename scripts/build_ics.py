@@ -1,23 +1,55 @@
 #!/usr/bin/env python3
 # scripts/build_ics.py — pre-pagination, single output (shropshire-events.ics)
 
-import os, re, json, hashlib, unicodedata
-from datetime import datetime, timedelta, timezone
-from typing import Optional, List, Dict
+import os, re, json, codecs, hashlib, unicodedata
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Optional, List, Dict, Tuple, Iterable, Iterator
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import lxml.etree
+import lxml.html
 import yaml
 
 try:
-    import feedparser  # optional: RSS
+    from yaml import CSafeLoader as _YamlLoader  # libyaml-backed when PyYAML was built with it
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+try:
+    import orjson  # optional: faster JSON
 except Exception:
-    feedparser = None
+    orjson = None
+
+_loads = orjson.loads if orjson else json.loads
 
 try:
-    from icalendar import Calendar  # optional: ICS import
+    import ciso8601  # optional: C ISO 8601 parser
 except Exception:
-    Calendar = None
+    ciso8601 = None
+
+# Heavier optional libraries are imported on first use, so a run that never reaches the
+# feedparser fallback, or has no ICS source, never pays for importing them.
+@lru_cache(maxsize=None)
+def _get_feedparser():
+    try:
+        import feedparser  # optional: fallback for feeds lxml can't parse
+        return feedparser
+    except Exception:
+        return None
+
+@lru_cache(maxsize=None)
+def _get_calendar():
+    try:
+        from icalendar import Calendar  # optional: ICS import
+        return Calendar
+    except Exception:
+        return None
 
 # --- Repo / output settings ---------------------------------------------------
 USERNAME   = "JonnyUtah100pc"
@@ -30,117 +62,351 @@ OUT_ICS    = os.path.join(REPO_ROOT, "shropshire-events.ics")   # single canonic
 STATE_PATH = os.path.join(REPO_ROOT, "data", "state.json")
 SOURCES_YAML = os.path.join(REPO_ROOT, "data", "sources.yaml")
 MANUAL_YAML  = os.path.join(REPO_ROOT, "data", "manual.yaml")
+CACHE_DIR    = os.path.join(REPO_ROOT, "data", "cache")          # last-seen bodies for 304s
+PARSE_CACHE_DIR = os.path.join(CACHE_DIR, "parse")              # extracted events per body
+
+# Bump whenever an extractor's output changes, so stale parse-cache entries are ignored
+PARSER_VERSION = 3
+
+# Content hash for SEQUENCE change detection (not security); recorded in state.json
+HASH_ALGO = "blake2b"
 
 # --- Window (30 days back, 2 years ahead) ------------------------------------
-WINDOW_START = datetime.now(timezone.utc) - timedelta(days=30)
-WINDOW_END   = datetime.now(timezone.utc) + timedelta(days=730)
+# Resolved against "now" once per run in main(), not at import time
+WINDOW_DAYS_BACK  = 30
+WINDOW_DAYS_AHEAD = 730
+
+# Sources are fetched concurrently (network-bound, threads), then parsed in-process:
+# with a handful of sources, a process pool would cost more than it saves
+FETCH_WORKERS = 16
+
+# Bodies are streamed and capped. A Content-Type that matches nothing in the source type's
+# list is dropped unread; a missing Content-Type is always let through.
+MAX_BYTES   = 4 * 1024 * 1024
+FETCH_CHUNK = 64 * 1024
+ACCEPT_TYPES = {
+    "jsonld": ("html", "xml", "json", "text"),
+    "rss":    ("xml", "html", "text"),                  # rss+xml, atom+xml, text/xml, ...
+    "ics":    ("calendar", "text", "octet-stream"),     # many calendar hosts send octet-stream
+}
 
 HEADERS = {
     "User-Agent": f"Mozilla/5.0 (compatible; ShropshireICSBot/1.3; +{HUB_URL})"
 }
 
+# One pooled session for every fetch: keep-alive/TLS reuse per host, retry on transient 5xx.
+# Retry-After is ignored: a 429/503 asking for an hour would stall a fetch thread (and the
+# run) that long, whereas the short backoff gives up quickly and the next run tries again.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+_adapter = HTTPAdapter(
+    pool_connections=32, pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                      respect_retry_after_header=False),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
 # Hints to boost Shrewsbury events
 SHREWSBURY_HINTS = [
     "shrewsbury", "originalshrewsbury", "theatresevern", "westmidshowground",
     "shrewsburyprison", "shrewsburyfolkfestival", "attingham", "the-quarry"
 ]
+# All hints in one alternation: a single C-level scan per event instead of one `in` per hint
+_SHREWSBURY_RE = re.compile("|".join(map(re.escape, SHREWSBURY_HINTS)))
 
 # ------------------------------------------------------------------------------
-def log(*a): print("[build_ics]", *a)
-
+def log(*a): print(" ".join(["[build_ics]", *map(str, a)]) + "\n", end="", flush=True)  # single write: safe across threads
+
+# Compiled once at import; slugify/parse_date_any run per event
+_SLUG_NONALNUM_RE = re.compile(r"[^a-zA-Z0-9]+")
+_SLUG_DASHES_RE   = re.compile(r"-{2,}")
+_ISO_DATE_RE      = re.compile(r"^(\d{4})-(\d{2})-(\d{2})$")
+_DATE_FMTS = (   # strptime fallbacks, tried in order after the ISO parsers
+    "%Y-%m-%dT%H:%M:%S%z",
+    "%Y-%m-%dT%H:%M:%S.%f%z",
+    "%Y-%m-%dT%H:%M%z",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d",
+)
+
+@lru_cache(maxsize=8192)   # pure; recurring series share a summary across years and sources
 def slugify(text: str) -> str:
     text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
-    text = re.sub(r"[^a-zA-Z0-9]+", "-", text).strip("-").lower()
-    text = re.sub(r"-{2,}", "-", text)
+    text = _SLUG_NONALNUM_RE.sub("-", text).strip("-").lower()
+    text = _SLUG_DASHES_RE.sub("-", text)
     return text or "event"
 
+def _as_utc(dt: datetime) -> datetime:
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+
 def parse_date_any(s: str) -> Optional[datetime]:
     if not s:
         return None
-    s = s.strip()
-    fmts = [
-        "%Y-%m-%dT%H:%M:%S%z",
-        "%Y-%m-%dT%H:%M:%S.%f%z",
-        "%Y-%m-%dT%H:%M%z",
-        "%Y-%m-%dT%H:%M:%S",
-        "%Y-%m-%d",
-    ]
-    for fmt in fmts:
+    if isinstance(s, datetime):   # YAML may already hand us datetimes...
+        return _as_utc(s)
+    if isinstance(s, date):       # ...or plain dates (manual.yaml `start: 2025-08-22`)
+        return datetime(s.year, s.month, s.day, tzinfo=timezone.utc)
+    return _parse_date_cached(str(s).strip())
+
+@lru_cache(maxsize=4096)
+def _parse_date_cached(s: str) -> Optional[datetime]:
+    # Keyed on the stripped string: the same dates recur across pages and sources,
+    # and the aware datetimes returned are immutable, so sharing them is safe.
+    m = _ISO_DATE_RE.match(s)     # all-day fast path
+    if m:
+        y, mo, d = map(int, m.groups())
         try:
-            dt = datetime.strptime(s, fmt)
-            if dt.tzinfo is None:
-                dt = dt.replace(tzinfo=timezone.utc)
-            else:
-                dt = dt.astimezone(timezone.utc)
-            return dt
-        except Exception:
+            return datetime(y, mo, d, tzinfo=timezone.utc)
+        except ValueError:        # well-formed but impossible, e.g. 2025-13-45
+            return None
+    # Nearly everything we scrape is ISO 8601: try the C parsers before strptime. Only full
+    # datetimes go to them, as both fill in missing parts ("2025-08" would become 1 August).
+    if len(s) > 10 and s[10] in "T ":
+        if ciso8601 is not None:
+            try:
+                return _as_utc(ciso8601.parse_datetime(s))
+            except ValueError:
+                pass
+        try:
+            return _as_utc(datetime.fromisoformat(s[:-1] + "+00:00" if s.endswith("Z") else s))
+        except ValueError:
             pass
-    if s.endswith("Z"):
+    for fmt in _DATE_FMTS:
         try:
-            return datetime.fromisoformat(s.replace("Z", "+00:00"))
+            return _as_utc(datetime.strptime(s, fmt))
         except Exception:
             pass
-    m = re.match(r"^(\d{4})-(\d{2})-(\d{2})$", s)
-    if m:
-        y, mo, d = map(int, m.groups())
-        return datetime(y, mo, d, tzinfo=timezone.utc)
     return None
 
+def ymd(dt: datetime) -> str:
+    return f"{dt.year:04d}{dt.month:02d}{dt.day:02d}"   # same as strftime("%Y%m%d"), minus the locale machinery
+
+_ICS_TRANS = str.maketrans({"\\": "\\\\", ",": "\\,", ";": "\\;", "\n": "\\n"})
+
+@lru_cache(maxsize=4096)   # pure; venue names and series descriptions repeat across events
 def escape_ics(text: str) -> str:
-    return str(text).replace("\\", "\\\\").replace(",", "\\,").replace(";", "\\;").replace("\n", "\\n")
+    return "" if text is None else str(text).translate(_ICS_TRANS)   # single pass, one allocation
+
+def _body_sha1(body: bytes) -> str:
+    # Cache key only, never a security boundary: usedforsecurity=False keeps FIPS builds happy
+    return hashlib.sha1(body, usedforsecurity=False).hexdigest()
+
+def _cache_path(body_sha1: str) -> str:
+    return os.path.join(CACHE_DIR, f"{body_sha1}.html")
+
+_CHARSET_RE = re.compile(r"""charset\s*=\s*["']?([\w.:-]+)""", re.I)
+
+def header_charset(content_type: Optional[str]) -> Optional[str]:
+    """Canonical codec name from a Content-Type charset parameter; None if absent or unknown."""
+    m = _CHARSET_RE.search(content_type or "")
+    if not m:
+        return None
+    try:
+        return codecs.lookup(m.group(1)).name
+    except LookupError:
+        return None
 
-def fetch(url: str) -> Optional[str]:
+def fetch(url: str, http_state: Optional[Dict] = None,
+          stype: Optional[str] = None) -> Tuple[Optional[bytes], Optional[str]]:
+    """Return (body, charset). The charset is the one the Content-Type header declared, if any.
+
+    Bodies stay bytes so XML and ICS parsers can honour their own encoding declarations;
+    the HTML extractor decodes with the header charset. Unlike r.text, an absent charset
+    is left as None and not guessed as ISO-8859-1.
+    With http_state, send a conditional GET and serve 304s from the on-disk body cache.
+    With stype, responses whose Content-Type doesn't fit ACCEPT_TYPES[stype] are skipped.
+    """
+    prev = (http_state or {}).get(url) or {}
+    cached = _cache_path(prev["body_sha1"]) if prev.get("body_sha1") else None
+    have_cached = bool(cached) and os.path.exists(cached)
+    headers = {}
+    if have_cached:
+        if prev.get("etag"):
+            headers["If-None-Match"] = prev["etag"]
+        if prev.get("last_modified"):
+            headers["If-Modified-Since"] = prev["last_modified"]
     try:
-        r = requests.get(url, headers=HEADERS, timeout=25)
-        if r.status_code == 200 and r.text:
-            return r.text
-        log("HTTP", r.status_code, "for", url)
+        with SESSION.get(url, headers=headers, timeout=25, stream=True) as r:
+            if r.status_code == 304 and have_cached:
+                log("304 (cached) for", url)
+                with open(cached, "rb") as f:
+                    return f.read(), prev.get("charset")
+            if r.status_code != 200:
+                log("HTTP", r.status_code, "for", url)
+                return None, None
+            ctype = (r.headers.get("Content-Type") or "").lower()
+            accept = ACCEPT_TYPES.get(stype)
+            if ctype and accept and not any(t in ctype for t in accept):
+                log("skip content-type", ctype, "for", url)
+                return None, None
+            buf = bytearray()
+            for chunk in r.iter_content(chunk_size=FETCH_CHUNK):
+                buf += chunk
+                if len(buf) > MAX_BYTES:
+                    log(f"skip body over {MAX_BYTES} bytes for", url)
+                    return None, None
+        if not buf:
+            log("HTTP 200 with empty body for", url)
+            return None, None
+        body = bytes(buf)
+        charset = header_charset(ctype)
+        if http_state is not None:
+            body_sha1 = _body_sha1(body)
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(_cache_path(body_sha1), "wb") as f:
+                f.write(body)
+            http_state[url] = {
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "body_sha1": body_sha1,
+                "charset": charset,
+            }
+        return body, charset
     except Exception as ex:
         log("ERR", ex, "for", url)
-    return None
+    return None, None
+
+def prune_cache(http_state: Dict) -> None:
+    """Drop cached bodies and parse results no longer referenced from state["http"]."""
+    shas = {v["body_sha1"] for v in http_state.values() if v.get("body_sha1")}
+    if os.path.isdir(CACHE_DIR):
+        for name in os.listdir(CACHE_DIR):
+            if name.endswith(".html") and name[:-5] not in shas:
+                os.remove(os.path.join(CACHE_DIR, name))
+    if os.path.isdir(PARSE_CACHE_DIR):
+        suffix = f"-v{PARSER_VERSION}.json"
+        for name in os.listdir(PARSE_CACHE_DIR):
+            if not name.endswith(suffix) or name.split("-", 1)[0] not in shas:
+                os.remove(os.path.join(PARSE_CACHE_DIR, name))
 
 # --- Extractors ---------------------------------------------------------------
-def extract_events_from_jsonld(html: str, base_url: str) -> List[Dict]:
+# schema.org types we treat as events (compared lowercased)
+_EVENT_TYPES = {"event", "musicevent", "theaterevent", "festival", "sportsevent"}
+
+# Compiled once and reused for every page, like a shared SoupStrainer
+_JSONLD_XPATH = lxml.etree.XPath('//script[@type="application/ld+json"]/text()')
+
+def _decode_html(html: bytes, charset: Optional[str]):
+    # Header charset wins. Without one, valid UTF-8 is taken as UTF-8; anything else stays
+    # bytes so lxml can apply a <meta charset> (its own last resort is Latin-1).
+    if charset:
+        return html.decode(charset, "replace")
+    try:
+        return html.decode("utf-8")
+    except UnicodeDecodeError:
+        return html
+
+def extract_events_from_jsonld(html: bytes, base_url: str, charset: Optional[str] = None) -> List[Dict]:
     out: List[Dict] = []
     if not html:
         return out
-    soup = BeautifulSoup(html, "lxml")
-    for tag in soup.find_all("script", {"type": "application/ld+json"}):
+    try:
         try:
-            import json as _json
-            raw = tag.string or "{}"
-            data = _json.loads(raw)
+            tree = lxml.html.fromstring(_decode_html(html, charset))
+        except ValueError:   # decoded text that still has an XML encoding declaration
+            tree = lxml.html.fromstring(html)
+    except Exception:
+        return out
+    for raw in _JSONLD_XPATH(tree):
+        # Most blobs are Organization/WebSite/BreadcrumbList: skip anything that can't
+        # mention an Event type before paying for the JSON decode. Every _EVENT_TYPES
+        # entry contains "event" or "festival", and @type is matched case-insensitively.
+        rl = raw.lower()
+        if not any(t in rl for t in ("event", "festival")):
+            continue
+        try:
+            data = _loads(raw.encode("utf-8"))
         except Exception:
             continue
         items = data.get("@graph") if isinstance(data, dict) and "@graph" in data else data
         if not isinstance(items, list):
             items = [data]
         for item in items:
-            t = item.get("@type")
-            tlist = [t] if not isinstance(t, list) else t
-            if not any(str(x).lower() == "event" for x in tlist if x):
+            if not isinstance(item, dict):
                 continue
-            name = item.get("name") or item.get("headline") or "Event"
-            start = item.get("startDate") or item.get("start") or item.get("startTime")
-            end = item.get("endDate") or item.get("end") or item.get("endTime") or start
-            url = item.get("url") or base_url
+            item_get = item.get
+            t = item_get("@type")
+            if t != "Event":   # fast path for the common plain type
+                tlist = t if isinstance(t, list) else [t]
+                if not {str(x).lower() for x in tlist if x} & _EVENT_TYPES:
+                    continue
+            name = item_get("name") or item_get("headline") or "Event"
+            start = item_get("startDate") or item_get("start") or item_get("startTime")
+            end = item_get("endDate") or item_get("end") or item_get("endTime") or start
+            url = item_get("url") or base_url
             loc = ""
-            location = item.get("location")
+            location = item_get("location")
             if isinstance(location, dict):
                 loc = location.get("name") or ""
                 addr = location.get("address")
-                if isinstance(addr, dict):
+                if isinstance(addr, dict) and addr:
                     parts = [addr.get(k, "") for k in ["streetAddress","addressLocality","addressRegion","postalCode"]]
                     loc = (loc + ", " + ", ".join([p for p in parts if p])).strip(", ")
-            desc = item.get("description") or ""
+            desc = item_get("description") or ""
             out.append({"summary": name, "start": start, "end": end, "url": url, "location": loc, "description": desc})
     return out
 
-def extract_events_from_rss(url: str) -> List[Dict]:
+ATOM = "{http://www.w3.org/2005/Atom}"
+RSS1 = "{http://purl.org/rss/1.0/}"                   # RDF-style RSS 1.0 items
+_XML_PARSER = lxml.etree.XMLParser(resolve_entities=False, no_network=True, recover=False)
+
+def _rfc822_to_iso(s: Optional[str]) -> Optional[str]:
+    # RSS pubDate is RFC 822 ("Mon, 01 Sep 2025 10:00:00 +0000"); parse_date_any wants ISO
+    if not s:
+        return s
+    try:
+        return parsedate_to_datetime(s).isoformat()
+    except Exception:
+        return s
+
+def extract_events_from_rss(xml: bytes, url: str, charset: Optional[str] = None) -> List[Dict]:
+    # charset is unused: XML carries its own declaration (UTF-8 when it has none)
+    if not xml:
+        return []
+    try:
+        root = lxml.etree.fromstring(xml, parser=_XML_PARSER)
+    except Exception:
+        return extract_events_from_rss_feedparser(xml, url)
+    res = []
+    if root.tag == ATOM + "feed":
+        for entry in root.iterfind(ATOM + "entry"):
+            link = url
+            for ln in entry.iterfind(ATOM + "link"):
+                if ln.get("rel", "alternate") == "alternate" and ln.get("href"):
+                    link = ln.get("href")
+                    break
+            start = (entry.findtext("{*}startdate") or entry.findtext(ATOM + "published")
+                     or entry.findtext(ATOM + "updated"))
+            res.append({
+                "summary": entry.findtext(ATOM + "title") or "Event",
+                "start": start,
+                "end": entry.findtext("{*}enddate") or start,
+                "url": link,
+                "location": entry.findtext("{*}location") or "",
+                "description": entry.findtext(ATOM + "summary") or entry.findtext(ATOM + "content") or "",
+            })
+        return res
+    for item in root.iter("item", RSS1 + "item"):
+        # ev:startdate/ev:enddate (RSS event module) first, then the publication date
+        start = (item.findtext("{*}startdate") or _rfc822_to_iso(item.findtext("pubDate"))
+                 or item.findtext("{*}date"))
+        res.append({
+            "summary": item.findtext("{*}title") or "Event",
+            "start": start,
+            "end": item.findtext("{*}enddate") or start,
+            "url": item.findtext("{*}link") or url,
+            "location": item.findtext("{*}location") or "",
+            "description": item.findtext("{*}description") or "",
+        })
+    return res
+
+def extract_events_from_rss_feedparser(xml: bytes, url: str) -> List[Dict]:
+    feedparser = _get_feedparser()
     if feedparser is None:
         return []
     try:
-        feed = feedparser.parse(url)
+        feed = feedparser.parse(xml)
     except Exception:
         return []
     res = []
@@ -153,14 +419,15 @@ def extract_events_from_rss(url: str) -> List[Dict]:
         res.append({"summary": title, "start": start, "end": end, "url": link, "location": "", "description": desc})
     return res
 
-def extract_events_from_ics(url: str) -> List[Dict]:
+def extract_events_from_ics(ics: bytes, url: str, charset: Optional[str] = None) -> List[Dict]:
+    # charset is unused: RFC 5545 calendars are UTF-8
+    if not ics:
+        return []
+    Calendar = _get_calendar()
     if Calendar is None:
         return []
     try:
-        r = requests.get(url, headers=HEADERS, timeout=25)
-        if r.status_code != 200:
-            return []
-        cal = Calendar.from_ical(r.content)
+        cal = Calendar.from_ical(ics)
     except Exception:
         return []
     out = []
@@ -184,34 +451,76 @@ def extract_events_from_ics(url: str) -> List[Dict]:
             edt = sdt
         if hasattr(edt, "year") and not hasattr(edt, "hour"):
             edt = dt(edt.year, edt.month, edt.day, tzinfo=timezone.utc)
-        out.append({"summary": summary, "start": sdt.isoformat(), "end": edt.isoformat(),
+        # Datetimes go out as-is: parse_date_any passes them straight through, no ISO round trip
+        out.append({"summary": summary, "start": sdt, "end": edt,
                     "url": link, "location": loc, "description": desc})
     return out
 
 # --- Helpers ------------------------------------------------------------------
 def is_shrewsbury_hit(e: Dict) -> bool:
-    text = " ".join([str(e.get("location", "")), str(e.get("url", "")), str(e.get("summary", ""))]).lower()
-    return any(h in text for h in SHREWSBURY_HINTS)
-
-def filter_window(evs: List[Dict]) -> List[Dict]:
+    text = f"{e.get('location', '')} {e.get('url', '')} {e.get('summary', '')}".lower()
+    return _SHREWSBURY_RE.search(text) is not None
+
+@dataclass(slots=True)
+class Event:
+    """An event inside the window: UTC start/end datetimes, text fields "" rather than None.
+
+    Dedupe merges later duplicates into the first Event seen for a key, in place.
+    """
+    summary: str
+    sdt: datetime
+    edt: datetime
+    url: str
+    location: str
+    description: str
+    is_shrewsbury: bool
+
+def filter_window(evs: List[Dict], window_start: datetime, window_end: datetime) -> List[Event]:
     out = []
+    # Start dates alone rule out undated and too-far-ahead events; only the rest need an end parsed
     for e in evs:
         sdt = parse_date_any(e.get("start", ""))
-        edt = parse_date_any(e.get("end", "")) or sdt
-        if not sdt:
+        if not sdt or sdt > window_end:
             continue
-        if edt < WINDOW_START or sdt > WINDOW_END:
+        edt = parse_date_any(e.get("end", "")) or sdt
+        if edt < window_start:
             continue
-        e["_sdt"], e["_edt"] = sdt, edt
-        e["_is_shrewsbury"] = is_shrewsbury_hit(e)
-        out.append(e)
+        out.append(Event(
+            e.get("summary") or "", sdt, edt,
+            e.get("url") or "", e.get("location") or "", e.get("description") or "",
+            is_shrewsbury_hit(e),
+        ))
     return out
 
+def _better(a: str, b: str) -> str:
+    """Dedupe merge: keep the longer of two field values (ties keep the first)."""
+    return a if len(a) >= len(b) else b
+
 def load_yaml(path: str) -> Dict:
     if not os.path.exists(path):
         return {}
     with open(path, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f) or {}
+        return yaml.load(f, Loader=_YamlLoader) or {}
+
+def load_json(path: str, default: Dict) -> Dict:
+    try:
+        with open(path, "rb") as f:
+            return _loads(f.read())
+    except Exception:
+        return default
+
+def save_json(path: str, data: Dict) -> None:
+    """Write JSON atomically: a run killed mid-write leaves the previous file intact."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Stays indented and key-sorted: state.json is committed, so it should diff line by line
+    if orjson:
+        payload = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+    else:
+        payload = json.dumps(data, ensure_ascii=False, indent=2, sort_keys=True).encode("utf-8")
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+    os.replace(tmp, path)
 
 def read_manual(path: str) -> List[Dict]:
     data = load_yaml(path)
@@ -227,161 +536,214 @@ def read_manual(path: str) -> List[Dict]:
         })
     return evs
 
-# --- Main ---------------------------------------------------------------------
-def main() -> int:
-    sources = load_yaml(SOURCES_YAML).get("sources", [])
-    events: List[Dict] = []
-
-    for src in sources:
-        stype = src.get("type")
-        url = src.get("url")
-        if not url:
-            continue
-        log("source:", stype, url)
+# --- Sources ------------------------------------------------------------------
+# Every extractor takes (body, url, charset) so fetching and parsing can run as separate stages
+EXTRACTORS = {
+    "jsonld": extract_events_from_jsonld,
+    "rss": extract_events_from_rss,
+    "ics": extract_events_from_ics,
+}
 
+def _parse_cache_path(stype: str, url: str, body: bytes, charset: Optional[str]) -> str:
+    # Keyed by the same SHA-1 as the body cache so prune_cache can match the two up;
+    # the charset is part of the key because the same bytes decode differently under another,
+    # and the URL because extractors fall back to it for each event's url
+    url_sha1 = _body_sha1(url.encode("utf-8"))[:12]
+    name = f"{_body_sha1(body)}-{url_sha1}-{stype}-{charset or 'auto'}-v{PARSER_VERSION}.json"
+    return os.path.join(PARSE_CACHE_DIR, name)
+
+def parse_source(stype: str, url: str, body: Optional[bytes], charset: Optional[str]) -> List[Dict]:
+    """Extract events from one fetched body.
+
+    Results are cached by body hash, so an unchanged page (a 304 or an identical 200)
+    is loaded from a small JSON file instead of being parsed again.
+    """
+    cached = _parse_cache_path(stype, url, body, charset) if body else None
+    evs = load_json(cached, None) if cached else None
+    if evs is not None:
+        log(f"  -> {len(evs)} raw events from {url} (parse cache)")
+    else:
         try:
-            if stype == "jsonld":
-                html = fetch(url)
-                evs = extract_events_from_jsonld(html, url)
-            elif stype == "rss":
-                evs = extract_events_from_rss(url)
-            elif stype == "ics":
-                evs = extract_events_from_ics(url)
-            else:
-                evs = []
+            evs = EXTRACTORS[stype](body, url, charset)
         except Exception as ex:
-            log("  error:", ex)
+            log("  error:", ex, "for", url)
             evs = []
-
-        log(f"  -> {len(evs)} raw events")
-        for e in evs:
-            e["_source"] = url
-        events.extend(evs)
-
-    # Add manual must-haves
-    manual = read_manual(MANUAL_YAML)
-    events.extend(manual)
-    log(f"[totals] raw + manual: {len(events)}")
-
-    # Window filter + tag
-    events = filter_window(events)
-    log(f"[totals] after window filter: {len(events)}")
-
-    # Deduplicate by (summary, start day) and prefer Shrewsbury-tagged entries
-    norm: Dict = {}
-    for e in events:
-        key = (e.get("summary") or "", e["_sdt"].strftime("%Y-%m-%d"))
-        if key in norm:
-            curr = norm[key]
-            if e["_is_shrewsbury"] and not curr.get("_is_shrewsbury"):
-                curr.update({
-                    "url": e.get("url", ""),
-                    "location": e.get("location", ""),
-                    "description": e.get("description", ""),
-                    "_is_shrewsbury": True
-                })
-            else:
-                def better(a, b): return a if len(a or "") >= len(b or "") else b
-                curr["url"] = curr.get("url") or e.get("url")
-                curr["description"] = better(curr.get("description"), e.get("description"))
-                curr["location"]     = better(curr.get("location"), e.get("location"))
-                curr["_edt"] = max(curr["_edt"], e["_edt"])
         else:
-            norm[key] = {
-                "summary": e.get("summary"),
-                "_sdt": e["_sdt"], "_edt": e["_edt"],
-                "url": e.get("url", ""), "location": e.get("location", ""),
-                "description": e.get("description", ""),
-                "_is_shrewsbury": e["_is_shrewsbury"],
-            }
-
-    log(f"[totals] after dedupe: {len(norm)} keys")
+            # An empty result may only mean a missing optional parser or a handled error;
+            # caching it would pin that [] until the body changes
+            if cached and evs:
+                _write_parse_cache(cached, evs)
+        log(f"  -> {len(evs)} raw events from {url}")
+    for e in evs:
+        e["_source"] = url
+    return evs
 
-    # Load previous state for SEQUENCE bumping
+def _write_parse_cache(path: str, evs: List[Dict]) -> None:
     try:
-        state = json.load(open(STATE_PATH, "r", encoding="utf-8"))
-    except Exception:
-        state = {"uids": {}}
+        os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+        # ICS events carry datetimes; both encoders write them as ISO 8601 strings
+        if orjson:
+            payload = orjson.dumps(evs)
+        else:
+            payload = json.dumps(evs, ensure_ascii=False, default=lambda o: o.isoformat()).encode("utf-8")
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(payload)
+        os.replace(tmp, path)
+    except Exception as ex:   # a cache miss next run is the only cost
+        log("  parse cache not written:", ex)
+
+# --- Output -------------------------------------------------------------------
+_VCAL_HEADER = (
+    "BEGIN:VCALENDAR",
+    "VERSION:2.0",
+    "PRODID:-//Shropshire Events Bot//EN",
+    "CALSCALE:GREGORIAN",
+    f"X-WR-CALNAME:{CAL_NAME}",
+    "X-WR-TIMEZONE:Europe/London",
+    f"URL:{HUB_URL}",
+    "REFRESH-INTERVAL;VALUE=DURATION:P1D",
+    "X-PUBLISHED-TTL:PT12H",
+)
+
+# Closing lines of a VEVENT depend only on the Shrewsbury flag
+_VEVENT_TAIL = {
+    flag: (
+        "CATEGORIES:Shropshire,Shrewsbury" if flag else "CATEGORIES:Shropshire",
+        "PRIORITY:1" if flag else "PRIORITY:5",
+        "STATUS:CONFIRMED",
+        "TRANSP:TRANSPARENT",
+        "END:VEVENT",
+    )
+    for flag in (True, False)
+}
 
+def vevent_lines_iter(events: Iterable[Event], state: Dict) -> Iterator[str]:
+    """Yield the VCALENDAR one content line at a time, updating state["uids"] as it goes."""
     seen_uids = set()
-    dtstamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
-    vevents = []
+    # Hashes written by a different algorithm can't be compared: re-stamp them without bumping SEQUENCE
+    restamp = state.get("hash_algo") != HASH_ALGO
+    dtstamp_line = f"DTSTAMP:{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}"   # same for every VEVENT
+
+    yield from _VCAL_HEADER
 
-    # Sort: Shrewsbury first, then by start date
-    for _, e in sorted(norm.items(), key=lambda kv: (not kv[1][\"_is_shrewsbury\"], kv[1][\"_sdt\"])):
-        summary = e["summary"] or "Event"
-        sdt, edt = e["_sdt"], e["_edt"]
+    for e in events:
+        summary = e.summary or "Event"
+        sdt, edt = e.sdt, e.edt
 
         # Stable UID: slug(summary)-YEAR@username.github.io
-        base_uid = f"{slugify(summary)}-{sdt.strftime('%Y')}@{USERNAME}.github.io"
-        uid = base_uid
-        i = 2
-        while uid in seen_uids:
+        base_uid = f"{slugify(summary)}-{sdt.year:04d}@{USERNAME}.github.io"
+        if base_uid not in seen_uids:   # the usual case: no collision, no suffix to format
+            uid = base_uid
+        else:
+            i = 2
             uid = f"{base_uid}-{i}"
-            i += 1
+            while uid in seen_uids:
+                i += 1
+                uid = f"{base_uid}-{i}"
         seen_uids.add(uid)
 
         # Hash to detect content changes for SEQUENCE
-        content_hash = hashlib.sha1("|".join([
-            summary, sdt.isoformat(), edt.isoformat(),
-            e["location"], e["description"], e["url"]
-        ]).encode("utf-8")).hexdigest()
+        h = hashlib.blake2b(digest_size=16, usedforsecurity=False)
+        h.update(summary.encode("utf-8"))
+        for piece in (sdt.isoformat(), edt.isoformat(), e.location, e.description, e.url):
+            h.update(b"|")   # same bytes as "|".join(...), without building the joined string
+            h.update(piece.encode("utf-8"))
+        content_hash = h.hexdigest()
 
         prev = state["uids"].get(uid, {})
         seq = int(prev.get("sequence", 0))
-        if prev.get("hash") and prev["hash"] != content_hash:
+        if prev.get("hash") and prev["hash"] != content_hash and not restamp:
             seq += 1
         state["uids"][uid] = {"hash": content_hash, "sequence": seq}
 
-        cats = ["Shropshire"]
-        if e["_is_shrewsbury"]:
-            cats.append("Shrewsbury")
-        categories = ",".join(cats)
-
-        def esc(x): return escape_ics(x) if x else ""
-
-        vevents.append("\n".join([
+        yield from (
             "BEGIN:VEVENT",
             f"UID:{uid}",
-            f"DTSTAMP:{dtstamp}",
+            dtstamp_line,
             f"SEQUENCE:{seq}",
-            f"DTSTART;VALUE=DATE:{sdt.strftime('%Y%m%d')}",
-            f"DTEND;VALUE=DATE:{(edt + timedelta(days=1)).strftime('%Y%m%d')}",
-            f"SUMMARY:{esc(summary)}",
-            f"LOCATION:{esc(e['location'])}" if e.get("location") else "LOCATION:",
-            f"DESCRIPTION:{esc(e['description'])}" if e.get("description") else "DESCRIPTION:",
-            f"URL:{e['url']}" if e.get("url") else "",
-            f"CATEGORIES:{categories}",
-            ("PRIORITY:1" if e["_is_shrewsbury"] else "PRIORITY:5"),
-            "STATUS:CONFIRMED",
-            "TRANSP:TRANSPARENT",
-            "END:VEVENT",
-        ]))
-
-    # Build VCALENDAR
-    vcal = "\n".join([
-        "BEGIN:VCALENDAR",
-        "VERSION:2.0",
-        "PRODID:-//Shropshire Events Bot//EN",
-        "CALSCALE:GREGORIAN",
-        f"X-WR-CALNAME:{CAL_NAME}",
-        "X-WR-TIMEZONE:Europe/London",
-        f"URL:{HUB_URL}",
-        "REFRESH-INTERVAL;VALUE=DURATION:P1D",
-        "X-PUBLISHED-TTL:PT12H",
-        *vevents,
-        "END:VCALENDAR",
-    ])
-
-    # Write single output
-    with open(OUT_ICS, "w", encoding="utf-8") as f:
-        f.write(vcal)
-
-    os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
-    with open(STATE_PATH, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
-
-    log(f"Wrote {OUT_ICS} with {len(vevents)} events.")
+            f"DTSTART;VALUE=DATE:{ymd(sdt)}",
+            f"DTEND;VALUE=DATE:{ymd(edt + timedelta(days=1))}",
+            f"SUMMARY:{escape_ics(summary)}",
+        )
+        # Empty properties are omitted rather than written as bare "NAME:" lines
+        if e.location:
+            yield f"LOCATION:{escape_ics(e.location)}"
+        if e.description:
+            yield f"DESCRIPTION:{escape_ics(e.description)}"
+        if e.url:
+            yield f"URL:{e.url}"
+        yield from _VEVENT_TAIL[e.is_shrewsbury]
+
+    yield "END:VCALENDAR"
+
+# --- Main ---------------------------------------------------------------------
+def main() -> int:
+    sources = [s for s in load_yaml(SOURCES_YAML).get("sources", []) if s.get("url")]
+    events: List[Dict] = []
+
+    # Previous state: UID hashes for SEQUENCE bumping, HTTP validators for conditional GETs
+    state = load_json(STATE_PATH, {"uids": {}})
+    state.setdefault("uids", {})
+    urls = {s["url"] for s in sources}
+    http_state = {u: v for u, v in state.get("http", {}).items() if u in urls}
+
+    def fetch_source(src: Dict) -> Tuple[Optional[bytes], Optional[str]]:
+        log("source:", src.get("type"), src["url"])
+        return fetch(src["url"], http_state, src["type"])
+
+    # Fetch all sources in parallel, then parse; map() keeps results in sources.yaml order
+    sources = [s for s in sources if s.get("type") in EXTRACTORS]
+    if sources:
+        with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(sources))) as ex:
+            fetched = list(ex.map(fetch_source, sources))
+        for src, (body, charset) in zip(sources, fetched):
+            events.extend(parse_source(src["type"], src["url"], body, charset))
+    state["http"] = http_state
+    prune_cache(http_state)
+
+    # Add manual must-haves
+    manual = read_manual(MANUAL_YAML)
+    events.extend(manual)
+    log(f"[totals] raw + manual: {len(events)}")
+
+    # Window filter + tag
+    now = datetime.now(timezone.utc)
+    events = filter_window(events, now - timedelta(days=WINDOW_DAYS_BACK), now + timedelta(days=WINDOW_DAYS_AHEAD))
+    log(f"[totals] after window filter: {len(events)}")
+
+    # Deduplicate by (summary, start day) and prefer Shrewsbury-tagged entries.
+    # The first Event seen for a key is kept and later duplicates are merged into it.
+    norm: Dict[Tuple[str, int], Event] = {}
+    for e in events:
+        key = (e.summary, e.sdt.toordinal())   # day granularity, no strftime
+        curr = norm.get(key)
+        if curr is None:
+            norm[key] = e
+        elif e.is_shrewsbury and not curr.is_shrewsbury:
+            curr.url, curr.location, curr.description = e.url, e.location, e.description
+            curr.is_shrewsbury = True
+        else:
+            curr.url = curr.url or e.url
+            curr.description = _better(curr.description, e.description)
+            curr.location = _better(curr.location, e.location)
+            curr.edt = max(curr.edt, e.edt)
+
+    log(f"[totals] after dedupe: {len(norm)} keys")
+
+    # Sort: Shrewsbury first, then by start date; sorted() builds each key tuple once
+    items = sorted(norm.values(), key=lambda e: (not e.is_shrewsbury, e.sdt))
+
+    # Stream the calendar out line by line as UTF-8; RFC 5545 wants CRLF after every line
+    with open(OUT_ICS, "wb", buffering=1 << 20) as f:
+        for line in vevent_lines_iter(items, state):
+            f.write(line.encode("utf-8"))
+            f.write(b"\r\n")
+
+    state["hash_algo"] = HASH_ALGO
+    save_json(STATE_PATH, state)
+
+    log(f"Wrote {OUT_ICS} with {len(items)} events.")
     return 0
 
 
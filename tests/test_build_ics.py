@@ -0,0 +1,148 @@
+import importlib.util
+import json
+import os
+import sys
+from datetime import datetime, timezone
+
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(__file__), "..", "scripts", "build_ics.py")
+spec = importlib.util.spec_from_file_location("build_ics", SCRIPT)
+build_ics = importlib.util.module_from_spec(spec)
+sys.modules["build_ics"] = build_ics
+spec.loader.exec_module(build_ics)
+
+# UTF-8 page with no <meta charset>: only the Content-Type header says how to decode it
+PAGE = """<html><head><script type="application/ld+json">
+{"@type": "Event", "name": "Café Concert, live; Shrewsbury", "startDate": "2026-05-01"}
+</script></head><body></body></html>""".encode("utf-8")
+
+
+class FakeResponse:
+    def __init__(self, body, content_type):
+        self.status_code = 200
+        self.headers = {"Content-Type": content_type}
+        self._body = body
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self._body), chunk_size):
+            yield self._body[i:i + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+@pytest.fixture
+def cache_dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(build_ics, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(build_ics, "PARSE_CACHE_DIR", str(tmp_path / "cache" / "parse"))
+
+
+def test_header_charset():
+    assert build_ics.header_charset("text/html; charset=UTF-8") == "utf-8"
+    assert build_ics.header_charset('text/html; charset="iso-8859-1"') == "iso8859-1"
+    assert build_ics.header_charset("text/html") is None
+    assert build_ics.header_charset("text/html; charset=bogus") is None
+
+
+@pytest.mark.parametrize("charset", ["utf-8", None])
+def test_jsonld_utf8_without_meta_charset(charset):
+    evs = build_ics.extract_events_from_jsonld(PAGE, "https://example.org/", charset)
+    assert [e["summary"] for e in evs] == ["Café Concert, live; Shrewsbury"]
+
+
+def test_fetch_and_parse_keep_header_charset(cache_dirs, monkeypatch):
+    url = "https://example.org/events"
+    monkeypatch.setattr(build_ics.SESSION, "get",
+                        lambda *a, **k: FakeResponse(PAGE, "text/html; charset=utf-8"))
+    http_state = {}
+    body, charset = build_ics.fetch(url, http_state)
+    assert charset == "utf-8" and http_state[url]["charset"] == "utf-8"
+
+    calls = []
+    extract = build_ics.EXTRACTORS["jsonld"]
+
+    def counting_extract(*args):
+        calls.append(args)
+        return extract(*args)
+
+    monkeypatch.setitem(build_ics.EXTRACTORS, "jsonld", counting_extract)
+    for _ in range(2):   # second pass is served from the parse cache
+        (ev,) = build_ics.parse_source("jsonld", url, body, charset)
+        assert ev["summary"] == "Café Concert, live; Shrewsbury"
+    assert len(calls) == 1
+    assert build_ics.escape_ics(ev["summary"]) == r"Café Concert\, live\; Shrewsbury"
+    assert build_ics.slugify(ev["summary"]) == "cafe-concert-live-shrewsbury"
+
+
+@pytest.mark.parametrize("stype, content_type, accepted", [
+    ("ics", "application/octet-stream", True),
+    ("ics", "", True),
+    ("ics", "text/calendar; charset=utf-8", True),
+    ("jsonld", "application/octet-stream", False),
+    ("rss", "image/png", False),
+])
+def test_fetch_content_type_gate(cache_dirs, monkeypatch, stype, content_type, accepted):
+    monkeypatch.setattr(build_ics.SESSION, "get",
+                        lambda *a, **k: FakeResponse(b"BEGIN:VCALENDAR\r\nEND:VCALENDAR\r\n", content_type))
+    body, _ = build_ics.fetch("https://example.org/feed", {}, stype)
+    assert (body is not None) == accepted
+
+
+@pytest.mark.parametrize("with_ciso8601", [True, False])
+def test_filter_window_drops_partial_dates(monkeypatch, with_ciso8601):
+    if with_ciso8601:
+        pytest.importorskip("ciso8601")
+    else:
+        monkeypatch.setattr(build_ics, "ciso8601", None)
+    build_ics._parse_date_cached.cache_clear()
+    start, end = datetime(2025, 1, 1, tzinfo=timezone.utc), datetime(2027, 1, 1, tzinfo=timezone.utc)
+    evs = [{"summary": s, "start": s} for s in ("2025", "2025-08", "2025-08-22", "")]
+    assert [e.summary for e in build_ics.filter_window(evs, start, end)] == ["2025-08-22"]
+
+
+def test_impossible_all_day_date_is_rejected():
+    assert build_ics.parse_date_any("2025-13-45") is None
+    assert build_ics.parse_date_any("2025-02-29") is None
+
+
+def test_sequence_bumps_on_edit_after_first_run():
+    sdt = datetime(2026, 5, 1, tzinfo=timezone.utc)
+
+    def run(state, description):
+        ev = build_ics.Event("Fair", sdt, sdt, "", "", description, False)
+        lines = list(build_ics.vevent_lines_iter([ev], state))
+        state["hash_algo"] = build_ics.HASH_ALGO
+        return next(l for l in lines if l.startswith("SEQUENCE:"))
+
+    state = {"uids": {}}
+    assert run(state, "v1") == "SEQUENCE:0"
+    assert state["uids"]["fair-2026@JonnyUtah100pc.github.io"]["hash"]
+    assert run(state, "v2") == "SEQUENCE:1"
+    assert run(state, "v2") == "SEQUENCE:1"
+
+
+def test_empty_parse_result_is_not_cached(cache_dirs, monkeypatch):
+    monkeypatch.setitem(build_ics.EXTRACTORS, "rss", lambda body, url, charset: [])
+    assert build_ics.parse_source("rss", "https://example.org/feed", b"<rss/>", None) == []
+    assert not os.path.exists(build_ics.PARSE_CACHE_DIR) or not os.listdir(build_ics.PARSE_CACHE_DIR)
+
+
+def test_parse_cache_is_per_url(cache_dirs):
+    # Same body at two addresses: each cached entry keeps its own url fallback
+    for url in ("https://example.org/a", "https://example.org/b", "https://example.org/a"):
+        (ev,) = build_ics.parse_source("jsonld", url, PAGE, "utf-8")
+        assert ev["url"] == url
+    assert len(os.listdir(build_ics.PARSE_CACHE_DIR)) == 2
+
+
+@pytest.mark.parametrize("type_", ["festival", "FESTIVAL", ["Thing", "MusicEvent"]])
+def test_jsonld_event_types_any_case(type_):
+    blob = json.dumps({"@type": type_, "name": "Folk", "startDate": "2026-08-22"})
+    org = json.dumps({"@type": "Organization", "name": "Venue"})
+    page = (f'<html><head><script type="application/ld+json">{org}</script>'
+            f'<script type="application/ld+json">{blob}</script></head></html>').encode()
+    assert [e["summary"] for e in build_ics.extract_events_from_jsonld(page, "https://example.org/")] == ["Folk"]